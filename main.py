@@ -1,10 +1,17 @@
 import streamlit as st
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from io import BytesIO
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
 import re
-import textwrap
+import hashlib
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from docx import Document
@@ -16,6 +23,11 @@ try:
 except ImportError:
     PyPDF2 = None
 
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
 try:
     from PIL import Image
     import pytesseract
@@ -34,6 +46,49 @@ DIAGRAM_TYPES = [
     "gitgraph",
 ]
 
+_STATUSES = ("Draft", "Accepted", "Rejected", "Implemented")
+_STATUS_IDX = {status: idx for idx, status in enumerate(_STATUSES)}
+
+_OCR_WORKERS = min(8, os.cpu_count() or 1)
+_DOWNLOAD_WORKERS = 16
+_BEDROCK_WORKERS = 4
+_BEDROCK_SETTING_KEYS = ("bedrock_agent_id", "bedrock_alias_id", "bedrock_region", "aws_access_key", "aws_secret_key")
+
+_PROMPT_TEXT_LIMIT = 5000
+_PREVIEW_LIMIT = 8000
+
+_AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "standard"},
+    tcp_keepalive=True,
+)
+
+_BEDROCK_CLIENT_CONFIG = Config(
+    max_pool_connections=16,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    connect_timeout=5,
+    read_timeout=180,
+    tcp_keepalive=True,
+)
+
+_S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+_META_FIELD_RE = re.compile(r'^\*\*(Author|Date|Status|Reviewers|Topic):\*\*[ \t]*(.*?)([ \t\r]*)$', re.MULTILINE)
+_META_FIELDS = ("author", "date", "status", "reviewers", "topic")
+_META_SCAN_CHARS = 8192
+_URL_RE = re.compile(r'https?://[^\s]+')
+_IMAGE_URL_RE = re.compile(r'https?://[^\s]+?\.(?:png|jpg|jpeg|gif)')
+_MERMAID_URL_PREFIXES = ("http://mermaid.live", "https://mermaid.live")
+_MERMAID_BLOCK_RE = re.compile(r'```mermaid\n(.*?)\n```', re.DOTALL)
+_MERMAID_CODE_RE = re.compile(r"```mermaid(.*?)(```|$)", re.DOTALL | re.IGNORECASE)
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})", re.MULTILINE)
+
 def set_background():
     st.markdown("""
         <style>
@@ -41,7 +96,7 @@ def set_background():
         .stTextArea textarea, .stFileUploader {background: #f7fbff !important;}
         .stButton button {background-color: #1976d2 !important; color: #fff !important; border-radius: 6px !important;}
         .stDownloadButton, .stDownloadButton button {background: #2196f3 !important; color: #fff !important; border-radius: 6px !important;}
-        .rfc-preview-area {background: #e3f2fd; border: 1.5px solid #2196F3; border-radius: 10px; padding: 1.5em; font-size: 1em; overflow-x: auto; margin-bottom: 0.7em;}
+        .rfc-preview-area, .st-key-rfc-preview-area {background: #e3f2fd; border: 1.5px solid #2196F3; border-radius: 10px; padding: 1.5em; font-size: 1em; overflow-x: auto; margin-bottom: 0.7em;}
         .stepper {margin-bottom: 15px; font-weight: bold; color: #1976d2; background: #e3f2fd; padding: 7px 18px; border-radius: 8px;}
         </style>
     """, unsafe_allow_html=True)
@@ -62,92 +117,131 @@ def show_stepper(current):
     txt += "</div>"
     st.markdown(txt, unsafe_allow_html=True)
 
+@st.cache_resource(show_spinner=False)
 def get_s3_client(aws_access_key, aws_secret_key, region):
     return boto3.client(
         "s3",
         region_name=region,
         aws_access_key_id=aws_access_key,
         aws_secret_access_key=aws_secret_key,
+        config=_AWS_CLIENT_CONFIG,
     )
 
-def list_buckets(s3_client):
+def s3_creds_key(session_state):
+    creds = "\0".join((session_state["aws_access_key"], session_state["aws_secret_key"], session_state["bedrock_region"]))
+    return hashlib.blake2b(creds.encode("utf-8"), digest_size=16).hexdigest()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_bucket_names(_s3_client, creds_key):
+    return [bucket["Name"] for bucket in _s3_client.list_buckets().get("Buckets", [])]
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_object_keys(_s3_client, bucket, creds_key):
+    return [obj["Key"] for obj in _s3_client.list_objects_v2(Bucket=bucket).get("Contents", [])]
+
+def list_buckets(s3_client, creds_key):
     try:
-        return [bucket["Name"] for bucket in s3_client.list_buckets().get("Buckets", [])]
+        return _cached_bucket_names(s3_client, creds_key)
     except Exception:
         return []
 
-def list_objects(s3_client, bucket):
+def list_objects(s3_client, bucket, creds_key):
     try:
-        return [obj["Key"] for obj in s3_client.list_objects_v2(Bucket=bucket).get("Contents", [])]
+        return _cached_object_keys(s3_client, bucket, creds_key)
     except Exception:
         return []
 
-def upload_to_s3(s3_client, bucket, filename, content_bytes):
-    s3_client.upload_fileobj(BytesIO(content_bytes), bucket, filename)
+def s3_object_etag(s3_client, bucket, key):
+    return s3_client.head_object(Bucket=bucket, Key=key)["ETag"]
+
+def download_from_s3(s3_client, bucket, key):
+    return s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
 
+def upload_to_s3(s3_client, bucket, filename, content_bytes, transfer_config=_S3_TRANSFER_CONFIG):
+    if len(content_bytes) < transfer_config.multipart_threshold:
+        s3_client.put_object(Bucket=bucket, Key=filename, Body=content_bytes)
+    else:
+        s3_client.upload_fileobj(BytesIO(content_bytes), bucket, filename, Config=transfer_config)
+    _cached_object_keys.clear()
+
+@st.cache_resource(show_spinner=False)
 def get_bedrock_agent_client(region, aws_access_key, aws_secret_key):
     return boto3.client(
         service_name="bedrock-agent-runtime",
         region_name=region,
         aws_access_key_id=aws_access_key,
         aws_secret_access_key=aws_secret_key,
+        config=_BEDROCK_CLIENT_CONFIG,
     )
 
-def bedrock_agent_ask(agent_id, alias_id, region, aws_access_key, aws_secret_key, user_message):
+def bedrock_agent_ask(agent_id, alias_id, region, aws_access_key, aws_secret_key, user_message, session_id="rfc-session", client=None):
     try:
-        client = get_bedrock_agent_client(region, aws_access_key, aws_secret_key)
+        if client is None:
+            client = get_bedrock_agent_client(region, aws_access_key, aws_secret_key)
         response_stream = client.invoke_agent(
             agentId=agent_id,
             agentAliasId=alias_id,
-            sessionId="rfc-session",
+            sessionId=session_id,
             inputText=user_message,
         )
-        output = ""
+        parts = []
         for event in response_stream['completion']:
-            if "chunk" in event and "bytes" in event["chunk"]:
-                output += event["chunk"]["bytes"].decode("utf-8")
-        return output.strip()
+            chunk = event.get("chunk")
+            if chunk and "bytes" in chunk:
+                parts.append(chunk["bytes"])
+        return b"".join(parts).decode("utf-8").strip()
     except Exception as e:
         return f"[Bedrock Agent Error: {e}]"
 
-def extract_images_from_docx(file_bytes):
+@st.cache_data(show_spinner=False, max_entries=64)
+def extract_docx_content(file_bytes):
+    try:
+        doc = Document(BytesIO(file_bytes))
+    except Exception:
+        return "[Could not extract text from DOCX]", []
+    text = "\n".join([p.text for p in doc.paragraphs])
     images = []
-    if Document is None:
-        return images
-    doc = Document(BytesIO(file_bytes))
     for rel in doc.part.rels.values():
         if "image" in rel.target_ref:
             img_blob = rel.target_part.blob
             images.append(img_blob)
-    return images
+    return text, images
 
-def extract_images_from_pdf(file_bytes):
-    images = []
-    if PyPDF2 is None:
-        return images
+def extract_images_from_docx(file_bytes):
+    if Document is None:
+        return []
+    return extract_docx_content(file_bytes)[1]
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def extract_pdf_content(file_bytes):
+    if fitz is None:
+        return None, []
     try:
-        import fitz
-    except ImportError:
-        return images
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    for page in doc:
-        for img in page.get_images(full=True):
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            images.append(image_bytes)
-    return images
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            texts = []
+            images = []
+            for page in doc:
+                texts.append(page.get_text())
+                for img in page.get_images(full=True):
+                    xref = img[0]
+                    base_image = doc.extract_image(xref)
+                    images.append(base_image["image"])
+            text = "\n".join(texts)
+        return text, images
+    except Exception:
+        return "[Could not extract text from PDF]", []
+
+def extract_images_from_pdf(file_bytes):
+    return extract_pdf_content(file_bytes)[1]
 
 def extract_text_from_file(file_bytes, file_name):
     ext = file_name.lower().split(".")[-1]
     if ext in ["md", "txt"]:
-        return file_bytes.decode("utf-8", errors="ignore")
+        return file_bytes.decode("utf-8", errors="replace")
     elif ext == "docx" and Document is not None:
-        try:
-            doc = Document(BytesIO(file_bytes))
-            return "\n".join([p.text for p in doc.paragraphs])
-        except Exception:
-            return "[Could not extract text from DOCX]"
+        return extract_docx_content(file_bytes)[0]
+    elif ext == "pdf" and fitz is not None:
+        return extract_pdf_content(file_bytes)[0]
     elif ext == "pdf" and PyPDF2 is not None:
         try:
             reader = PyPDF2.PdfReader(BytesIO(file_bytes))
@@ -155,7 +249,7 @@ def extract_text_from_file(file_bytes, file_name):
         except Exception:
             return "[Could not extract text from PDF]"
     try:
-        return file_bytes.decode("utf-8", errors="ignore")
+        return file_bytes.decode("utf-8", errors="replace")
     except Exception:
         return "[Unsupported file type or unreadable content]"
 
@@ -170,7 +264,7 @@ def extract_images_from_file(file_bytes, file_name):
     else:
         return []
 
-def ocr_image_bytes(image_bytes):
+def run_ocr(image_bytes):
     if Image is None or pytesseract is None:
         return "[OCR not available: Tesseract or Pillow is not installed]"
     try:
@@ -179,43 +273,85 @@ def ocr_image_bytes(image_bytes):
     except Exception as e:
         return f"[OCR not available: {e}]"
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def ocr_image_bytes(image_bytes):
+    return run_ocr(image_bytes)
+
+@st.cache_resource(show_spinner=False)
+def get_ocr_executor():
+    return ThreadPoolExecutor(max_workers=_OCR_WORKERS)
+
+def ocr_images(images):
+    return list(get_ocr_executor().map(run_ocr, images))
+
+def start_background_ocr(session_state):
+    ocr_key = session_state.images_key
+    if ocr_key in (session_state.get("ocr_texts_key"), session_state.get("ocr_futures_key")):
+        return
+    session_state.ocr_futures = [get_ocr_executor().submit(run_ocr, b) for b in session_state.images]
+    session_state.ocr_futures_key = ocr_key
+
+def session_ocr_texts(session_state):
+    ocr_key = session_state.images_key
+    if session_state.get("ocr_texts_key") != ocr_key:
+        with st.spinner("Running OCR..."):
+            if session_state.get("ocr_futures_key") == ocr_key:
+                session_state.ocr_texts = [f.result() for f in session_state.ocr_futures]
+            else:
+                session_state.ocr_texts = ocr_images(session_state.images)
+        session_state.ocr_texts_key = ocr_key
+        session_state.pop("ocr_futures", None)
+        session_state.pop("ocr_futures_key", None)
+    return session_state.ocr_texts
+
+@st.cache_data(show_spinner=False, max_entries=64)
 def extract_metadata_from_markdown(md_text):
-    regex = r"\*\*Author:\*\* (.*?)\s*[\r\n]+.*?\*\*Date:\*\* (.*?)\s*[\r\n]+.*?\*\*Status:\*\* (.*?)\s*[\r\n]+.*?\*\*Reviewers:\*\* (.*?)\s*[\r\n]+.*?\*\*Topic:\*\* (.*?)\s*[\r\n]+"
-    m = re.search(regex, md_text, re.DOTALL)
-    if m:
-        return {
-            "author": m.group(1).strip(),
-            "date": m.group(2).strip(),
-            "status": m.group(3).strip(),
-            "reviewers": m.group(4).strip(),
-            "topic": m.group(5).strip()
-        }
+    found = {}
+    for m in _META_FIELD_RE.finditer(md_text, 0, _META_SCAN_CHARS):
+        found.setdefault(m.group(1).lower(), m.group(2))
+    if all(field in found for field in _META_FIELDS):
+        return {field: found[field] for field in _META_FIELDS}
     return {}
 
+@st.cache_data(show_spinner=False, max_entries=64)
 def update_metadata_in_markdown(md_text, new_metadata):
-    pattern = r'(\*\*Author:\*\*\s*)(.*?)(\s*[\r\n]+)(.*?)(\*\*Date:\*\*\s*)(.*?)(\s*[\r\n]+)(.*?)(\*\*Status:\*\*\s*)(.*?)(\s*[\r\n]+)(.*?)(\*\*Reviewers:\*\*\s*)(.*?)(\s*[\r\n]+)(.*?)(\*\*Topic:\*\*\s*)(.*?)(\s*[\r\n]+)'
-    repl = (
-        r'\g<1>{author}\g<3>\g<4>\g<5>{date}\g<7>\g<8>\g<9>{status}\g<11>\g<12>\g<13>{reviewers}\g<15>\g<16>\g<17>{topic}\g<19>'
-    ).format(
-        author=new_metadata.get("author", ""),
-        date=new_metadata.get("date", ""),
-        status=new_metadata.get("status", ""),
-        reviewers=new_metadata.get("reviewers", ""),
-        topic=new_metadata.get("topic", "")
-    )
-    new_md = re.sub(pattern, repl, md_text, flags=re.DOTALL)
-    return new_md
+    seen = set()
+    def repl(m):
+        field = m.group(1).lower()
+        if field in seen:
+            return m.group(0)
+        seen.add(field)
+        return f"**{m.group(1)}:** {new_metadata.get(field, '')}{m.group(3)}"
+    return _META_FIELD_RE.sub(repl, md_text)
 
 def extract_external_diagram_links(text):
-    image_urls = re.findall(r'(https?://[^\s]+?\.(?:png|jpg|jpeg|gif))', text)
-    drawio_urls = re.findall(r'(https?://[^\s]*draw\.io[^\s]*)', text)
-    mermaid_urls = re.findall(r'(https?://mermaid\.live[^\s]*)', text)
-    mermaid_blocks = re.findall(r'```mermaid\n(.*?)\n```', text, re.DOTALL)
+    image_urls, drawio_urls, mermaid_urls = [], [], []
+    if "http" in text:
+        has_drawio = "draw.io" in text
+        has_mermaid_url = "mermaid.live" in text
+        for url in _URL_RE.findall(text):
+            m = _IMAGE_URL_RE.match(url)
+            if m:
+                image_urls.append(m.group(0))
+            if has_drawio and "draw.io" in url:
+                drawio_urls.append(url)
+            if has_mermaid_url and url.startswith(_MERMAID_URL_PREFIXES):
+                mermaid_urls.append(url)
+    mermaid_blocks = _MERMAID_BLOCK_RE.findall(text) if "```mermaid" in text else []
     return image_urls, drawio_urls, mermaid_urls, mermaid_blocks
 
-def download_image(url):
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=_DOWNLOAD_WORKERS, pool_maxsize=_DOWNLOAD_WORKERS))
+    session.mount("https://", HTTPAdapter(pool_connections=_DOWNLOAD_WORKERS, pool_maxsize=_DOWNLOAD_WORKERS))
+    return session
+
+def download_image(url, session=None):
     try:
-        resp = requests.get(url)
+        if session is None:
+            session = get_http_session()
+        resp = session.get(url, timeout=5)
         if resp.ok:
             return resp.content
     except Exception:
@@ -240,15 +376,16 @@ def extract_mermaid_from_mermaid_url(mermaid_url):
     except Exception:
         return "[Could not extract mermaid code from URL]"
 
-def process_document_for_diagrams(file_bytes, file_name, file_text=None):
+def download_images(urls):
+    if not urls:
+        return []
+    session = get_http_session()
+    with ThreadPoolExecutor(max_workers=_DOWNLOAD_WORKERS) as ex:
+        return [img_bytes for img_bytes in ex.map(lambda url: download_image(url, session), urls) if img_bytes]
+
+def collect_document_diagrams(file_bytes, file_name, file_text):
     images = extract_images_from_file(file_bytes, file_name)
-    if file_text is None:
-        file_text = extract_text_from_file(file_bytes, file_name)
     image_urls, drawio_urls, mermaid_urls, mermaid_blocks = extract_external_diagram_links(file_text)
-    for url in image_urls:
-        img_bytes = download_image(url)
-        if img_bytes:
-            images.append(img_bytes)
     mermaid_diagrams = []
     for drawio_url in drawio_urls:
         mermaid_diagrams.append(extract_mermaid_from_drawio(drawio_url))
@@ -256,15 +393,73 @@ def process_document_for_diagrams(file_bytes, file_name, file_text=None):
         mermaid_diagrams.append(extract_mermaid_from_mermaid_url(mermaid_url))
     for mb in mermaid_blocks:
         mermaid_diagrams.append(mb.strip())
-    return images, mermaid_diagrams
+    return images, image_urls, mermaid_diagrams
+
+def content_hash(file_bytes):
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
 
 def extract_mermaid_code(response):
-    m = re.search(r"```mermaid(.*?)(```|$)", response, re.DOTALL | re.IGNORECASE)
+    m = _MERMAID_CODE_RE.search(response)
     if m:
         return m.group(1).strip()
     return response.strip()
 
-def mermaid_from_image(description, session_state, diagram_type):
+def bedrock_settings(session_state):
+    return {k: session_state[k] for k in _BEDROCK_SETTING_KEYS}
+
+def parse_batched_mermaids(response):
+    m = _JSON_OBJECT_RE.search(response)
+    if not m:
+        return {}
+    try:
+        diagrams = json.loads(m.group(0)).get("diagrams", [])
+        return {int(d["idx"]): extract_mermaid_code(d["mermaid"]) for d in diagrams}
+    except Exception:
+        return {}
+
+def batched_mermaids_from_images(descriptions, session_state, diagram_type):
+    items = "".join(
+        f"\nDescription {idx}:\n{description}\n"
+        for idx, description in enumerate(descriptions)
+        if description.strip()
+    )
+    prompt = (
+        f"For each diagram description below, generate a detailed Mermaid diagram using type '{diagram_type}'. "
+        f'Return ONLY a JSON object of the form {{"diagrams": [{{"idx": <description number>, "mermaid": "```mermaid ... ```"}}]}}, '
+        f"with one entry per description, and NOTHING else.\n"
+        f"{items}"
+    )
+    response = bedrock_agent_ask(
+        session_state['bedrock_agent_id'],
+        session_state['bedrock_alias_id'],
+        session_state['bedrock_region'],
+        session_state['aws_access_key'],
+        session_state['aws_secret_key'],
+        prompt
+    )
+    return parse_batched_mermaids(response)
+
+def mermaids_from_images(descriptions, session_state, diagram_type):
+    settings = bedrock_settings(session_state)
+    pending = [idx for idx, d in enumerate(descriptions) if d.strip()]
+    mermaids = {}
+    if len(pending) > 1:
+        batched = batched_mermaids_from_images(descriptions, settings, diagram_type)
+        mermaids = {idx: batched[idx] for idx in pending if batched.get(idx)}
+    missing = [idx for idx in range(len(descriptions)) if idx not in mermaids]
+    if missing:
+        client = get_bedrock_agent_client(settings["bedrock_region"], settings["aws_access_key"], settings["aws_secret_key"])
+        with ThreadPoolExecutor(max_workers=_BEDROCK_WORKERS) as ex:
+            results = ex.map(
+                lambda idx: mermaid_from_image(
+                    descriptions[idx], settings, diagram_type, session_id=str(uuid.uuid4()), client=client
+                ),
+                missing,
+            )
+            mermaids.update(zip(missing, results))
+    return [mermaids[idx] for idx in range(len(descriptions))]
+
+def mermaid_from_image(description, session_state, diagram_type, session_id="rfc-session", client=None):
     if not description.strip():
         return "[No OCR or image description available]"
     prompt = (
@@ -278,10 +473,42 @@ def mermaid_from_image(description, session_state, diagram_type):
         session_state['bedrock_region'],
         session_state['aws_access_key'],
         session_state['aws_secret_key'],
-        prompt
+        prompt,
+        session_id=session_id,
+        client=client,
     )
     return extract_mermaid_code(response)
 
+def shorten_text(text, width):
+    if len(text) <= width:
+        return text
+    return text[:width].rsplit(" ", 1)[0] + "..."
+
+def encoded_markdown(session_state, name, md_text):
+    md_hash = hash(md_text)
+    if session_state.get(f"_{name}_hash") != md_hash:
+        session_state[f"_{name}_bytes"] = md_text.encode("utf-8")
+        session_state[f"_{name}_hash"] = md_hash
+    return session_state[f"_{name}_bytes"]
+
+def preview_markdown(md_text, limit=_PREVIEW_LIMIT):
+    if len(md_text) <= limit:
+        return md_text
+    head = md_text[:limit].rsplit("\n", 1)[0]
+    open_fence = None
+    for m in _FENCE_RE.finditer(head):
+        fence = m.group(1)
+        if open_fence is None:
+            open_fence = fence
+        elif fence[0] == open_fence[0] and len(fence) >= len(open_fence):
+            open_fence = None
+    if open_fence:
+        head += "\n" + open_fence
+    return head + "\n\n… (truncated, check \"Show full preview\" to view the full RFC)"
+
+def show_preview(md_text):
+    st.markdown(f'<div class="rfc-preview-area">\n\n{md_text}\n\n</div>', unsafe_allow_html=True)
+
 def markdown_from_ai(doc_text, image_mermaids, metadata, session_state, diagram_type, custom_prompt=None, prompt_image_text=None):
     author = metadata.get("author") or "Unknown"
     topic = metadata.get("topic") or "Unknown"
@@ -382,7 +609,7 @@ The document MUST use this structure:
 ---
 
 Extracted document text:
-{textwrap.shorten(doc_text, width=5000, placeholder='...')}
+{shorten_text(doc_text, _PROMPT_TEXT_LIMIT)}
 
 - Fill each section with content from the provided text if possible. Use placeholder sentences if necessary.
 - When rendering diagrams, always use fenced Markdown code blocks with the mermaid language identifier.
@@ -464,7 +691,7 @@ def file_choice_ui():
             key="upload_any"
         )
         if uploaded_file:
-            file_content = uploaded_file.read()
+            file_content = uploaded_file.getvalue()
             file_name = uploaded_file.name
             st.session_state.file_origin = "upload"
             st.session_state.file_content = file_content
@@ -473,17 +700,14 @@ def file_choice_ui():
     with col_s3:
         st.subheader("Select from S3 Bucket")
         if "s3_client" in st.session_state:
-            buckets = list_buckets(st.session_state.s3_client)
+            buckets = list_buckets(st.session_state.s3_client, s3_creds_key(st.session_state))
             bucket = st.selectbox("S3 Bucket", buckets, key="bucket_select")
             if bucket:
-                objects = list_objects(st.session_state.s3_client, bucket)
+                objects = list_objects(st.session_state.s3_client, bucket, s3_creds_key(st.session_state))
                 if objects:
                     s3_file = st.selectbox("File in bucket", objects, key="s3_file_select")
                     if st.button("Load file from S3", key="load_s3_file"):
-                        file_obj = BytesIO()
-                        st.session_state.s3_client.download_fileobj(bucket, s3_file, file_obj)
-                        file_obj.seek(0)
-                        file_content = file_obj.read()
+                        file_content = download_from_s3(st.session_state.s3_client, bucket, s3_file)
                         file_name = s3_file
                         st.session_state.file_origin = "s3"
                         st.session_state.file_content = file_content
@@ -523,19 +747,24 @@ def metadata_ui():
     metadata = st.session_state.metadata
     author = st.text_input("Author", value=metadata.get("author", ""))
     topic = st.text_input("Topic", value=metadata.get("topic", ""))
-    status = st.selectbox("Status", ["Draft", "Accepted", "Rejected", "Implemented"], index=["Draft", "Accepted", "Rejected", "Implemented"].index(metadata.get("status", "Draft")))
+    status = st.selectbox("Status", _STATUSES, index=_STATUS_IDX.get(metadata.get("status", "Draft"), 0))
     reviewers = st.text_input("Reviewers (comma-separated)", value=metadata.get("reviewers", ""))
     date = st.text_input("Date", value=metadata.get("date", datetime.now().strftime("%Y-%m-%d")))
     if st.button("Extract & Convert with AI"):
-        images, mermaid_diagrams = process_document_for_diagrams(st.session_state.file_content, st.session_state.file_name)
         text = extract_text_from_file(st.session_state.file_content, st.session_state.file_name)
+        images, image_urls, mermaid_diagrams = collect_document_diagrams(
+            st.session_state.file_content, st.session_state.file_name, text
+        )
+        images = images + download_images(image_urls)
         st.session_state.metadata = {
             "author": author, "topic": topic, "status": status,
             "reviewers": reviewers, "date": date,
         }
         st.session_state.text_content = text
         st.session_state.images = images
+        st.session_state.images_key = tuple(content_hash(img_bytes) for img_bytes in images)
         st.session_state.external_mermaid_diagrams = mermaid_diagrams
+        start_background_ocr(st.session_state)
         st.session_state.stage = "image_mermaid"
         st.rerun()
     if st.button("⬅️ Back to File Selection", key="back_to_filechoice", help="Back to file selection", type="primary"):
@@ -561,9 +790,10 @@ def image_mermaid_ui():
     chosen_type = st.session_state.diagram_type
     if len(images) == 0 and len(external_mermaid_diagrams) == 0:
         st.info("No images or diagrams detected in the file. You can proceed to RFC draft directly.")
+    ocr_texts = session_ocr_texts(st.session_state)
     for idx, img_bytes in enumerate(images):
         st.image(img_bytes, caption=f"Image {idx+1}", use_container_width=True)
-        ocr_text = ocr_image_bytes(img_bytes)
+        ocr_text = ocr_texts[idx]
         ocr_text_key = f"ocr_text_{idx}"
         st.markdown(f"**OCR for Image {idx+1}** *(edit or describe if needed)*:")
         ocr_text = st.text_area(f"OCR Text for Image {idx+1}", value=ocr_text, key=ocr_text_key)
@@ -634,9 +864,7 @@ def md_review_ui():
         if new_code != st.session_state.md_code_edit:
             st.session_state.md_code_edit = new_code
     with tab_preview:
-        st.markdown('<div class="rfc-preview-area">', unsafe_allow_html=True)
-        st.markdown(st.session_state.md_code_edit, unsafe_allow_html=True)
-        st.markdown("</div>", unsafe_allow_html=True)
+        show_preview(st.session_state.md_code_edit)
     st.markdown("---")
     st.markdown("<h3 style='color:#1565C0;'>AI-Driven RFC Update & Regeneration</h3>", unsafe_allow_html=True)
     with st.form("ai_rfc_form"):
@@ -661,7 +889,7 @@ def md_review_ui():
         regenerate = st.form_submit_button("Regenerate RFC Document with AI")
     prompt_image_text = ""
     if prompt_file is not None:
-        prompt_file_bytes = prompt_file.read()
+        prompt_file_bytes = prompt_file.getvalue()
         prompt_file_name = prompt_file.name
         if prompt_file.type.startswith('image/'):
             if Image is not None:
@@ -671,17 +899,11 @@ def md_review_ui():
         st.success(f"Context file '{prompt_file_name}' attached.")
     if regenerate:
         with st.spinner("Updating RFC document with AI..."):
-            new_image_mermaids = []
-            for idx, img_bytes in enumerate(st.session_state.images):
-                ocr_desc = ocr_image_bytes(img_bytes)
+            ocr_descs = list(session_ocr_texts(st.session_state))
+            for idx, ocr_desc in enumerate(ocr_descs):
                 if not ocr_desc.strip():
-                    ocr_desc = st.session_state.get(f"ocr_text_{idx}", "")
-                mermaid = mermaid_from_image(
-                    ocr_desc,
-                    st.session_state,
-                    chosen_type
-                )
-                new_image_mermaids.append(mermaid)
+                    ocr_descs[idx] = st.session_state.get(f"ocr_text_{idx}", "")
+            new_image_mermaids = mermaids_from_images(ocr_descs, st.session_state, chosen_type)
             for idx, mermaid_code in enumerate(st.session_state.external_mermaid_diagrams):
                 key = f"external_mermaid_{idx}"
                 code = st.session_state.get(key, mermaid_code)
@@ -701,12 +923,13 @@ def md_review_ui():
             st.session_state.diagram_type = chosen_type
             st.rerun()
     st.markdown("---")
+    md_bytes = encoded_markdown(st.session_state, "md_code", st.session_state.md_code_edit)
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Upload RFC Markdown Document to S3"):
             upload_bucket = st.session_state.get("bucket") or st.selectbox(
                 "Select S3 bucket to upload .md",
-                list_buckets(st.session_state.s3_client),
+                list_buckets(st.session_state.s3_client, s3_creds_key(st.session_state)),
                 key="up_bucket",
             )
             md_filename = st.text_input(
@@ -719,7 +942,7 @@ def md_review_ui():
                         st.session_state.s3_client,
                         upload_bucket,
                         md_filename,
-                        st.session_state.md_code_edit.encode("utf-8"),
+                        md_bytes,
                     )
                     st.success(
                         f"RFC Markdown file uploaded to '{upload_bucket}' as '{md_filename}'!"
@@ -729,7 +952,7 @@ def md_review_ui():
     with col2:
         st.download_button(
             label="Download RFC Markdown Document",
-            data=st.session_state.md_code_edit,
+            data=md_bytes,
             file_name=st.session_state.file_name.rsplit(".", 1)[0] + "_RFC.md",
             mime="text/markdown",
         )
@@ -748,76 +971,97 @@ def manager_comment_ui():
     show_stepper(5)
     st.markdown("<h2 style='color:#1976D2'>Step: Review & Comment on Existing RFC</h2>", unsafe_allow_html=True)
     st.markdown("Select a bucket and an existing RFC Markdown file from S3 to review and comment on:")
-    buckets = list_buckets(st.session_state.s3_client)
+    buckets = list_buckets(st.session_state.s3_client, s3_creds_key(st.session_state))
     bucket = st.selectbox("Select a bucket", buckets, key="mgr_bucket_select")
     rfc_file = None
     rfc_md = ""
     if bucket:
-        objects = [f for f in list_objects(st.session_state.s3_client, bucket) if f.lower().endswith(".md")]
+        objects = [f for f in list_objects(st.session_state.s3_client, bucket, s3_creds_key(st.session_state)) if f.lower().endswith(".md")]
         rfc_file = st.selectbox("Select an RFC Markdown file", objects, key="mgr_file_select")
         if rfc_file:
-            file_obj = BytesIO()
-            st.session_state.s3_client.download_fileobj(bucket, rfc_file, file_obj)
-            file_obj.seek(0)
-            rfc_md = file_obj.read().decode("utf-8", errors="ignore")
+            try:
+                etag = s3_object_etag(st.session_state.s3_client, bucket, rfc_file)
+                rfc_md_source = (s3_creds_key(st.session_state), bucket, rfc_file, etag)
+                if st.session_state.get("rfc_md_source") != rfc_md_source:
+                    st.session_state.rfc_md = download_from_s3(st.session_state.s3_client, bucket, rfc_file).decode("utf-8", errors="ignore")
+                    st.session_state.rfc_md_hash = hash(st.session_state.rfc_md)
+                    st.session_state.rfc_md_source = rfc_md_source
+                rfc_md = st.session_state.rfc_md
+            except Exception as e:
+                st.error(f"Could not load '{rfc_file}': {e}")
     if rfc_md:
         st.markdown("#### RFC Metadata (Editable)")
         md_metadata = extract_metadata_from_markdown(rfc_md)
         if not md_metadata:
             st.info("No RFC metadata fields detected. The file may not be in standard RFC format.")
         else:
-            col1, col2 = st.columns(2)
-            with col1:
-                author = st.text_input("Author", value=md_metadata.get("author", ""))
-                status = st.selectbox("Status", ["Draft", "Accepted", "Rejected", "Implemented"], index=["Draft", "Accepted", "Rejected", "Implemented"].index(md_metadata.get("status", "Draft")))
-            with col2:
-                reviewers = st.text_input("Reviewers (comma-separated)", value=md_metadata.get("reviewers", ""))
-                date = st.text_input("Date", value=md_metadata.get("date", ""))
-            topic = st.text_input("Topic", value=md_metadata.get("topic", ""))
-            updated_metadata = dict(author=author, status=status, reviewers=reviewers, date=date, topic=topic)
-            updated_md = update_metadata_in_markdown(rfc_md, updated_metadata)
-            st.markdown('<div class="rfc-preview-area">', unsafe_allow_html=True)
-            st.markdown(updated_md)
-            st.markdown('</div>', unsafe_allow_html=True)
+            if st.session_state.get("mgr_metadata_source") != st.session_state.rfc_md_source:
+                st.session_state.mgr_metadata = md_metadata
+                st.session_state.mgr_metadata_source = st.session_state.rfc_md_source
+            applied_metadata = st.session_state.mgr_metadata
+            with st.form("metadata_form"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    author = st.text_input("Author", value=applied_metadata.get("author", ""))
+                    status = st.selectbox("Status", _STATUSES, index=_STATUS_IDX.get(applied_metadata.get("status", "Draft"), 0))
+                with col2:
+                    reviewers = st.text_input("Reviewers (comma-separated)", value=applied_metadata.get("reviewers", ""))
+                    date = st.text_input("Date", value=applied_metadata.get("date", ""))
+                topic = st.text_input("Topic", value=applied_metadata.get("topic", ""))
+                applied = st.form_submit_button("Apply")
+            if applied:
+                st.session_state.mgr_metadata = dict(author=author, status=status, reviewers=reviewers, date=date, topic=topic)
+            meta_key = (st.session_state.rfc_md_hash, tuple(st.session_state.mgr_metadata.items()))
+            if st.session_state.get("_mgr_meta_key") != meta_key:
+                st.session_state._mgr_updated_md = update_metadata_in_markdown(rfc_md, st.session_state.mgr_metadata)
+                st.session_state._mgr_meta_key = meta_key
+            updated_md = st.session_state._mgr_updated_md
+            show_full = len(updated_md) <= _PREVIEW_LIMIT or st.checkbox("Show full preview", key="mgr_show_full_preview")
+            with st.container(key="rfc-preview-area"):
+                st.markdown(updated_md if show_full else preview_markdown(updated_md))
         comment = st.text_area("Manager Comments", placeholder="Write your comments or review feedback here...")
         append_comments = st.checkbox("Append comments to RFC Markdown (at the end)", value=True)
-        final_md = updated_md if md_metadata else rfc_md
-        if comment.strip() and append_comments:
-            final_md += f"\n\n---\n## Manager Comments\n{comment}\n"
-        elif comment.strip():
-            final_md = f"## Manager Comments\n{comment}\n\n---\n" + final_md
+        fragments = [updated_md if md_metadata else rfc_md]
+        has_comment = bool(comment) and not comment.isspace()
+        if has_comment and append_comments:
+            fragments.append(f"\n\n---\n## Manager Comments\n{comment}\n")
+        elif has_comment:
+            fragments.insert(0, f"## Manager Comments\n{comment}\n\n---\n")
+        final_md = "".join(fragments)
         st.markdown("#### Updated RFC Markdown (with comments)")
-        st.text_area("RFC Markdown (with comments)", value=final_md, height=350, key="mgr_md_edit")
+        if st.checkbox("Edit final markdown", key="mgr_edit_final_md"):
+            final_md = st.text_area("RFC Markdown (with comments)", value=final_md, height=350, key="mgr_md_edit")
+        final_md_bytes = encoded_markdown(st.session_state, "final_md", final_md)
+        base_name = rfc_file.rsplit(".", 1)[0] if rfc_file else "rfc"
+        upload_filename = f"{base_name}_with_comments.md"
         st.download_button(
             label="Download RFC Markdown (with comments)",
-            data=final_md,
-            file_name=(rfc_file.rsplit(".", 1)[0] + "_with_comments.md") if rfc_file else "rfc_with_comments.md",
+            data=final_md_bytes,
+            file_name=upload_filename,
             mime="text/markdown",
         )
         if st.button("Upload Updated RFC with Comments to S3"):
-            upload_filename = (rfc_file.rsplit(".", 1)[0] + "_with_comments.md") if rfc_file else "rfc_with_comments.md"
             try:
-                upload_to_s3(st.session_state.s3_client, bucket, upload_filename, final_md.encode("utf-8"))
+                upload_to_s3(st.session_state.s3_client, bucket, upload_filename, final_md_bytes)
                 st.success(f"RFC Markdown with comments uploaded as '{upload_filename}' to bucket '{bucket}'!")
             except Exception as e:
                 st.error(f"Upload failed: {e}")
     if st.button("⬅️ Back", key="back_to_choose", help="Back to option selection", type="primary"):
+        st.session_state.pop("mgr_metadata_source", None)
+        st.session_state.pop("rfc_md_source", None)
         st.session_state.stage = "choose_rfc_or_new"
         st.rerun()
 
+_STAGES = {
+    "login": login_ui,
+    "choose_rfc_or_new": choose_rfc_or_new_ui,
+    "manager_comment": manager_comment_ui,
+    "file_choice": file_choice_ui,
+    "metadata": metadata_ui,
+    "image_mermaid": image_mermaid_ui,
+    "md_review": md_review_ui,
+}
+
 if "stage" not in st.session_state:
     st.session_state.stage = "login"
-if st.session_state.stage == "login":
-    login_ui()
-elif st.session_state.stage == "choose_rfc_or_new":
-    choose_rfc_or_new_ui()
-elif st.session_state.stage == "manager_comment":
-    manager_comment_ui()
-elif st.session_state.stage == "file_choice":
-    file_choice_ui()
-elif st.session_state.stage == "metadata":
-    metadata_ui()
-elif st.session_state.stage == "image_mermaid":
-    image_mermaid_ui()
-elif st.session_state.stage == "md_review":
-    md_review_ui()
\ No newline at end of file
+_STAGES[st.session_state.stage]()